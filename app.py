@@ -1,33 +1,196 @@
 import os
+import json
+import time
+import asyncio
+import threading
+import functools
+from collections import deque
+from contextlib import asynccontextmanager, suppress
+import numpy as np
 import chromadb
 from dotenv import load_dotenv
 from fastapi import FastAPI,HTTPException
 from pydantic import BaseModel,Field
-from sentence_transformers import SentenceTransformer
-from openai import OpenAI
+from embeddings import load_embedding_model
+from openai import AsyncOpenAI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 
 load_dotenv()
 
 # --- 1. Initialize Models and Database ---
 print("Initalizing components...")
 
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+# The encoder comes from embeddings.py: ONNX Runtime on CPU, FP16 PyTorch with EMBEDDING_DEVICE=cuda.
+# Weight bandwidth dominates inference for this small encoder, so on CPU the
+# int8 dynamically quantized model is served (set EMBEDDING_INT8=0 for FP32)
+embedding_model = load_embedding_model(quantized=os.getenv("EMBEDDING_INT8", "1") == "1")
 client = chromadb.PersistentClient(path='chroma_db')
 collection = client.get_collection(name='ai_papers')
-groq_client = OpenAI(
+groq_client = AsyncOpenAI(
     api_key=os.getenv("GROQ_API_KEY"),
     base_url="https://api.groq.com/openai/v1"
 )
 
 print("Initialization Complete")
 
+TOP_K = int(os.getenv("TOP_K", 10))
+
+SYSTEM_PROMPT = """You are an AI Research Assistant. Answer the user's question based *only* on the context they provide.
+If the context does not contain the answer, say "I cannot find the answer in the provided documents"
+Answer with specific references to papers when possible"""
+
+# Only the retrieved context and the question change per request
+USER_PROMPT_TEMPLATE = """Context:
+{context}
+
+Question: {question}"""
+
+# --- Semantic Response Cache ---
+# Paraphrased questions land close to each other in embedding space, so a
+# cached answer is reused when a new question is similar enough to an old one.
+# This skips both the Chroma query and the LLM call on a hit.
+CACHE_SIM_THRESHOLD = float(os.getenv("CACHE_SIM_THRESHOLD", 0.92))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", 3600))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 1000))
+
+_cache_lock = threading.Lock()
+_cache_embs = np.empty((0, embedding_model.get_sentence_embedding_dimension()), dtype=np.float32)
+_cache_vals = [] # (answer, chunks_used) for each row of _cache_embs
+_cache_times = deque() # insertion time of each entry, oldest first
+
+def _cache_evict(n):
+    """
+        Drops the n oldest cache entries. Caller must hold _cache_lock.
+    """
+    global _cache_embs
+    if n <= 0:
+        return
+    _cache_embs = _cache_embs[n:]
+    del _cache_vals[:n]
+    for _ in range(n):
+        _cache_times.popleft()
+
+def _cache_expire():
+    """
+        Drops entries older than CACHE_TTL_SECONDS. Caller must hold _cache_lock.
+    """
+    now = time.monotonic()
+    expired = 0
+    for inserted_at in _cache_times:
+        if now - inserted_at <= CACHE_TTL_SECONDS:
+            break
+        expired += 1
+    _cache_evict(expired)
+
+def cache_lookup(embedding):
+    """
+        Returns the cached (answer, chunks_used) for the most similar previous question,
+        or None if nothing is above CACHE_SIM_THRESHOLD. Expects a unit-norm embedding.
+    """
+    with _cache_lock:
+        _cache_expire()
+        if not _cache_vals:
+            return None
+        sims = _cache_embs @ embedding
+        best = int(np.argmax(sims))
+        if sims[best] > CACHE_SIM_THRESHOLD:
+            return _cache_vals[best]
+    return None
+
+def cache_store(embedding, value):
+    """
+        Adds a unit-norm question embedding and its (answer, chunks_used) to the cache.
+    """
+    global _cache_embs
+    with _cache_lock:
+        _cache_embs = np.vstack([_cache_embs, embedding[None, :]])
+        _cache_vals.append(value)
+        _cache_times.append(time.monotonic())
+        _cache_evict(len(_cache_vals) - CACHE_MAX_ENTRIES)
+
+# --- Embedding Micro-Batcher ---
+class EmbeddingBatcher:
+    """
+        Coalesces concurrent encode requests into a single batched model.encode call.
+        Questions queued within max_wait_ms of each other (up to max_batch_size) are
+        encoded together in a worker thread, so the event loop is never blocked.
+    """
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms/1000
+        self._queue = None
+        self._task = None
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+
+    async def encode(self, text):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text,future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(),timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text,_ in batch]
+            try:
+                embeddings = await loop.run_in_executor(
+                    None,
+                    functools.partial(
+                        self.model.encode,
+                        texts,
+                        batch_size=len(texts),
+                        convert_to_numpy=True,
+                        normalize_embeddings=True
+                    )
+                )
+            except Exception as e:
+                for _,future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_,future),embedding in zip(batch,embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+embedding_batcher = EmbeddingBatcher(
+    embedding_model,
+    max_batch_size=int(os.getenv("EMBED_MAX_BATCH_SIZE", 32)),
+    max_wait_ms=float(os.getenv("EMBED_MAX_WAIT_MS", 5))
+)
+
 # --- FastAPI App ---
+@asynccontextmanager
+async def lifespan(app):
+    await embedding_batcher.start()
+    yield
+    await embedding_batcher.stop()
+
 app = FastAPI(
     title="AI Research Assistant API",
     description="RAG-based Q&A system for AI/ML research papers",
-    version = "1.0.0"
+    version = "1.0.0",
+    lifespan=lifespan
 )
 
 # ADD CORS - Cross Origin Resource Sharing
@@ -54,84 +217,162 @@ class QueryResponse(BaseModel):
     answer: str
     chunks_used: int
 
-# --- 2. Main RAG Logic in a Function ---
+# --- 2. Main RAG Logic in Functions ---
 
-def answer_question(question):
+async def embed_question(question):
     """
-        Takes a user's question, retrieves relevant context and generates an answer.
+        Converts the question into a unit-norm embedding (the batcher normalizes it).
     """
-    print(f"Received Question: {question}")
-
-    # --- RETRIEVAL STEP ---
-    # Convert the question into an embedding
-    question_embedding = embedding_model.encode(question)
+    question_embedding = await embedding_batcher.encode(question)
+    return question_embedding.astype(np.float32,copy=False)
 
+async def build_messages(question,question_embedding):
+    """
+        Retrieves the most relevant chunks for the question and builds the LLM messages.
+        Returns the messages and the number of chunks used as context.
+    """
     # Search the Chroma DB for the most relevant chunks
-    # We'll retrieve the top 5 most similar chunks
-    results = collection.query(
-        query_embeddings=[question_embedding.tolist()],
-        n_results=30
+    # We'll retrieve the TOP_K most similar chunks, the token budget below
+    # rarely has room for more than a handful of them
+    results = await asyncio.to_thread(
+        collection.query,
+        query_embeddings=question_embedding[None, :], # 1 x dim float32 array, no list conversion
+        n_results=TOP_K,
+        include=['documents','distances','metadatas']
     )
 
+    ids = results['ids'][0]
     documents = results['documents'][0]
-    distances = results['distances'][0]
-
-    sorted_docs = sorted(zip(documents,distances),key=lambda x:x[1])
-    selected_chunks_with_distances = []
-    total_tokens=0
+    metadatas = results['metadatas'][0]
+    distances = np.asarray(results['distances'][0])
     MAX_CONTEXT_TOKENS=4000
 
-    for doc,dist in sorted_docs:
-        doc_tokens=len(doc)//4
-        if total_tokens + doc_tokens < MAX_CONTEXT_TOKENS:
-            selected_chunks_with_distances.append((doc,dist))
-            total_tokens+=doc_tokens
-        else:
-            break
+    # Rank chunks by distance and keep the closest ones while the running
+    # token count stays under the budget. Token counts are stored with each
+    # chunk at build time, older databases without them fall back to ~4 chars per token
+    order = np.argsort(distances,kind='stable')
+    doc_tokens = np.fromiter(
+        ((meta or {}).get('n_tok',len(doc)//4) for doc,meta in zip(documents,metadatas)),
+        dtype=np.int64,
+        count=len(documents)
+    )[order]
+    cumulative_tokens = np.cumsum(doc_tokens)
+    keep = order[cumulative_tokens < MAX_CONTEXT_TOKENS]
+    total_tokens = int(cumulative_tokens[len(keep)-1]) if len(keep) else 0
 
-    print(f"\nSelected {len(selected_chunks_with_distances)} chunks (~{total_tokens} tokens) to send to LLM.")
+    print(f"\nSelected {len(keep)} chunks ({total_tokens} tokens) to send to LLM.")
     # print("\n--- Top Retrieved Chunks (with distances) ---")
-    # for i, (chunk, distance) in enumerate(selected_chunks_with_distances[:5], 1): # Show top 5
-    #     print(f"\n--- Chunk {i} (Distance: {distance:.4f}) ---")
-    #     print(chunk)
+    # for i, idx in enumerate(keep[:5], 1): # Show top 5
+    #     print(f"\n--- Chunk {i} (Distance: {distances[idx]:.4f}) ---")
+    #     print(documents[idx])
     # print("\n--- End of Chunks ---")
 
-    # Extract just the text to join for the context
-    selected_context = [item[0] for item in selected_chunks_with_distances]
+    # Order the selected chunks by chunk id rather than by distance, so the same
+    # set of chunks always produces the same context string
+    selected_context = [documents[i] for i in sorted(keep,key=lambda i: int(ids[i]))]
     retrieved_context = "\n\n".join(selected_context)
     
     print("Retrieved context from the database.")
 
-    # --- GENERATION STEP ---
-    # Create the prompt for the LLM
-    # Prompt includes the Persona, the Rule, the Context, the Question
-    prompt = f"""
-    You are an AI Research Assistant. Answer the user's question based *only* on the following context.
-    If the context does not contain the answer, say "I cannot find the answer in the provided documents"
-    Context:
-    ---
-    {retrieved_context}
-    ---
+    # Build the messages for the LLM
+    # The static persona and rules go first as the system message so the
+    # provider can reuse its prompt prefix cache, the context and question follow
+    user_prompt = USER_PROMPT_TEMPLATE.format(context=retrieved_context,question=question)
+    messages = [
+        {'role':'system','content':SYSTEM_PROMPT},
+        {'role':'user','content':user_prompt}
+    ]
+    return messages,len(selected_context)
 
-    Question: {question}
-
-    Answer with specific references to papers when possible
+async def answer_question(question):
+    """
+        Takes a user's question, retrieves relevant context and generates an answer.
     """
+    print(f"Received Question: {question}")
+
+    # --- RETRIEVAL STEP ---
+    question_embedding = await embed_question(question)
+
+    cached = cache_lookup(question_embedding)
+    if cached is not None:
+        print("Semantic cache hit, returning cached answer.")
+        return cached
+
+    messages,chunks_used = await build_messages(question,question_embedding)
+
+    # --- GENERATION STEP ---
     print("Sending request to Groq to generate the final answer...")
 
     try:
-        response = groq_client.chat.completions.create(
+        response = await groq_client.chat.completions.create(
             model = "llama-3.1-8b-instant",
-            messages = [
-                {'role':'user','content':prompt}
-            ],
+            messages = messages,
             max_tokens=1000
         )
         final_answer = response.choices[0].message.content
-        return final_answer,len(selected_chunks_with_distances)
+        result = (final_answer,chunks_used)
+        # Empty/None completions aren't cached, so the next request retries the LLM
+        if final_answer:
+            cache_store(question_embedding, result)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM Error: {str(e)}")
 
+def sse_event(data):
+    """
+        Formats a dict as a Server-Sent Events message.
+    """
+    return f"data: {json.dumps(data)}\n\n"
+
+async def stream_answer(question):
+    """
+        Same pipeline as answer_question, but yields the answer as Server-Sent Events
+        while the LLM generates it. Emits {"token": ...} events followed by a final
+        {"done": true, "chunks_used": ...} event.
+    """
+    print(f"Received Question (stream): {question}")
+
+    # Headers are already sent once streaming starts, so failures are reported
+    # as an error event instead of an HTTP status code
+    try:
+        question_embedding = await embed_question(question)
+
+        cached = cache_lookup(question_embedding)
+        if cached is not None:
+            print("Semantic cache hit, returning cached answer.")
+            final_answer,chunks_used = cached
+            yield sse_event({"token":final_answer})
+            yield sse_event({"done":True,"chunks_used":chunks_used})
+            return
+
+        messages,chunks_used = await build_messages(question,question_embedding)
+    except Exception as e:
+        yield sse_event({"error":f"Error: {str(e)}"})
+        return
+
+    print("Streaming request to Groq to generate the final answer...")
+    answer_parts = []
+    try:
+        stream = await groq_client.chat.completions.create(
+            model = "llama-3.1-8b-instant",
+            messages = messages,
+            max_tokens=1000,
+            stream=True
+        )
+        async for chunk in stream:
+            token = chunk.choices[0].delta.content if chunk.choices else None
+            if token:
+                answer_parts.append(token)
+                yield sse_event({"token":token})
+    except Exception as e:
+        yield sse_event({"error":f"LLM Error: {str(e)}"})
+        return
+
+    # A stream with no content (e.g. filtered) isn't cached, so paraphrases retry the LLM
+    if answer_parts:
+        cache_store(question_embedding, ("".join(answer_parts),chunks_used))
+    yield sse_event({"done":True,"chunks_used":chunks_used})
+
 # --- 3. API Endpoints ---
 
 @app.get("/",response_class=FileResponse)
@@ -148,7 +389,7 @@ async def health_check():
     """
     try:
         count = collection.count() #to check if vector store is live and connected
-        embedding_model.encode("test") # to load the complex embedding model into computer's memory
+        await embedding_batcher.encode("test") # to load the complex embedding model into computer's memory
         return {"status":"healthy",
                 "database_docs":count}
     except Exception as e:
@@ -160,7 +401,7 @@ async def ask_question(request: QueryRequest):
     Ask a question about AI/ML research papers
     """
     try:
-        final_answer,chunks_used = answer_question(request.question)
+        final_answer,chunks_used = await answer_question(request.question)
         return QueryResponse(
             question = request.question,
             answer = final_answer,
@@ -171,6 +412,13 @@ async def ask_question(request: QueryRequest):
     except Exception as e:
         raise HTTPException(status_code=500,
                             detail=f"Error: {str(e)}")
+
+@app.post("/ask/stream")
+async def ask_question_stream(request: QueryRequest):
+    """
+    Ask a question and stream the answer back as Server-Sent Events
+    """
+    return StreamingResponse(stream_answer(request.question),media_type="text/event-stream")
     
         
 if __name__ == "__main__":
@@ -2,21 +2,58 @@ import os
 import json
 import pymupdf
 import time
+import numpy as np
+import tiktoken
 import chromadb
-from sentence_transformers import SentenceTransformer
+from chromadb.errors import NotFoundError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from embeddings import load_embedding_model, EMBEDDING_DEVICE
 
 def read_pdf(file_path):
+    # Yields the text one page at a time so the whole document never has to be
+    # held as a single string. Read errors propagate to the caller
+    doc = pymupdf.open(file_path)
     try:
-        doc = pymupdf.open(file_path)
-        full_text = "".join(page.get_text("text") for page in doc)
+        for page in doc:
+            yield page.get_text("text")
+    finally:
         doc.close()
-        return full_text
+    
+def chunking(pages,chunk_size=3000,overlap=200):
+    # Consumes page texts and yields overlapping windows as soon as they are full,
+    # buffering at most one page plus a chunk_size tail instead of the joined text.
+    # The buffer is trimmed once per page, not once per chunk, to avoid re-copying it.
+    # Produces the same chunks as slicing the joined text every chunk_size-overlap chars
+    stride = chunk_size-overlap
+    buffer = ""
+    for page_text in pages:
+        buffer += page_text
+        start = 0
+        while len(buffer)-start >= chunk_size:
+            yield buffer[start:start+chunk_size]
+            start += stride
+        buffer = buffer[start:]
+    for i in range(0,len(buffer),stride):
+        yield buffer[i:i+chunk_size]
+
+def process_pdf(file_path,title):
+    # Runs in a worker process: pymupdf documents can't be sent between
+    # processes, so the PDF is opened, read and chunked all on the worker side.
+    # Each chunk is enriched with the paper title as soon as it is sliced, and
+    # its exact token count is computed here so tokenization runs in parallel too.
+    # Returns a list of (enriched_chunk, n_tok) pairs
+    # A document that fails partway through is skipped entirely rather than
+    # indexing the pages read before the error
+    tokenizer = tiktoken.get_encoding("cl100k_base") # cached per process by tiktoken
+    chunks = []
+    try:
+        for chunk in chunking(read_pdf(file_path)):
+            enriched_chunk = f"Paper Title: {title}\n\n{chunk}"
+            chunks.append((enriched_chunk,len(tokenizer.encode(enriched_chunk,disallowed_special=()))))
     except Exception as e:
         print(f"Error reading {file_path}: {e}")
         return None
-    
-def chunking(full_text,chunk_size=3000,overlap=200):
-    return [full_text[i:i+chunk_size] for i in range(0,len(full_text),chunk_size-overlap)]
+    return chunks or None
 
 if __name__ == "__main__":
     strat_time = time.time()
@@ -34,56 +71,101 @@ if __name__ == "__main__":
     all_chunks=[]
     metadatas=[]
 
-    for i,pdf_file in enumerate(pdf_files):
-        file_path = os.path.join(papers_folder,pdf_file)
-        print(f"Processing file {i+1}/{len(pdf_files)} : {pdf_file}")
-        document_text = read_pdf(file_path)
-
-        if document_text:
-            chunks = chunking(document_text)
-            # Get the title from our cache
-            title = titles_cache.get(pdf_file, {}).get('title', pdf_file) # Fallback to filename
-            
-            # Create context-enriched chunks and their metadata
-            # for each chunk in a document create a metadata dictionary
-            for chunk in chunks:
-                enriched_chunk = f"Paper Title: {title}\n\n{chunk}"
-                all_chunks.append(enriched_chunk)
-                metadatas.append({'source': pdf_file, 'title': title})
-
-            print(f"-> Extracted {len(chunks)} enriched chunks.")
+    # Parse and chunk the PDFs in parallel, PyMuPDF text extraction is CPU bound
+    file_paths = [os.path.join(papers_folder,pdf_file) for pdf_file in pdf_files]
+    max_workers = min(os.cpu_count() or 1, 6)
+    print(f"Reading PDFs with {max_workers} worker processes...")
+
+    # Get the titles from our cache
+    titles = [titles_cache.get(pdf_file, {}).get('title', pdf_file) for pdf_file in pdf_files] # Fallback to filename
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(process_pdf,file_paths,titles)
+        for i,(pdf_file,title,chunks) in enumerate(zip(pdf_files,titles,results)):
+            print(f"Processing file {i+1}/{len(pdf_files)} : {pdf_file}")
+
+            if chunks:
+                # Store the context-enriched chunks and their metadata
+                # for each chunk in a document create a metadata dictionary.
+                # Exact token counts are stored with each chunk so the app can
+                # fill its context budget without estimating tokens at query time
+                for enriched_chunk,n_tok in chunks:
+                    all_chunks.append(enriched_chunk)
+                    metadatas.append({
+                        'source': pdf_file,
+                        'title': title,
+                        'n_tok': n_tok
+                    })
+
+                print(f"-> Extracted {len(chunks)} enriched chunks.")
         
-    # --- 2. Create Embeddings ---
+    # --- 2. Load the Embedding Model ---
     print("Loading embeddings model...")
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-
-    print("Creating embeddings for all chunks...")
-    embeddings = model.encode(all_chunks,show_progress_bar=True)
-    print(f"Embeddings created with shape : {embeddings.shape}")
+    # Same model the app serves (ONNX on CPU, FP16 with EMBEDDING_DEVICE=cuda), on CPU
+    # documents are embedded with the full precision graph
+    model = load_embedding_model()
+    encode_batch_size = 64 if EMBEDDING_DEVICE == "cuda" else 32
+
+    def encode_batch(start,end):
+        # The encoder length-sorts its inputs into batches, so padding is kept
+        # low without reordering all_chunks here
+        return model.encode(
+            all_chunks[start:end],
+            batch_size=encode_batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        ).astype(np.float32,copy=False)
 
     # --- 3. Build and Save the Chroma DB Vector Store ---
     print("Building the ChromaDB vector store...")
 
     # Create Persistent Database "chroma_db" and collection "ai_papers"
     client = chromadb.PersistentClient(path='chroma_db')
-    collection = client.get_or_create_collection(name='ai_papers')
+    # HNSW parameters are fixed when a collection is created, so drop any
+    # collection left over from a previous build before creating it again.
+    # Only a missing collection is expected here, anything else must stop the
+    # build rather than silently reuse the old index
+    try:
+        client.delete_collection(name='ai_papers')
+    except NotFoundError:
+        pass
+    # Embeddings are unit-normalized, so inner product ranks exactly like cosine
+    # similarity without the extra norm computations; a denser graph (M) and
+    # wider construction/search beams trade a little index size for recall
+    collection = client.get_or_create_collection(
+        name='ai_papers',
+        metadata={
+            "hnsw:space": "ip",
+            "hnsw:construction_ef": 128,
+            "hnsw:M": 24,
+            "hnsw:search_ef": 100
+        }
+    )
 
     # Creating unique ids for chunks for ChromaDB
     chunk_ids = [str(i) for i in range(len(all_chunks))]
 
-    # Add the documents and embeddings to the collection in batches
-    batch_size = 500
-    for i in range(0,len(all_chunks),batch_size):
-        batch_end = i+batch_size
-        collection.add(
-            ids=chunk_ids[i:batch_end],
-            embeddings=embeddings[i:batch_end],
-            documents=all_chunks[i:batch_end],
-            metadatas=metadatas[i:batch_end]
-        )
-        print(f"Added batch {i//batch_size + 1} to Chroma DB")
-
-
+    # Embed and add the documents in batches. The next batch is encoded in a
+    # background thread while the current one is written to Chroma, so the
+    # insert cost is hidden behind the encoding
+    print("Creating embeddings and adding them to Chroma DB...")
+    batch_size = min(2048, client.get_max_batch_size())
+    batch_starts = range(0,len(all_chunks),batch_size)
+    with ThreadPoolExecutor(max_workers=1) as encoder:
+        next_embeddings = encoder.submit(encode_batch,0,batch_size)
+        for n,i in enumerate(batch_starts):
+            batch_end = i+batch_size
+            embeddings = next_embeddings.result()
+            if batch_end < len(all_chunks):
+                next_embeddings = encoder.submit(encode_batch,batch_end,batch_end+batch_size)
+
+            collection.add(
+                ids=chunk_ids[i:batch_end],
+                embeddings=embeddings,
+                documents=all_chunks[i:batch_end],
+                metadatas=metadatas[i:batch_end]
+            )
+            print(f"Added batch {n+1}/{len(batch_starts)} to Chroma DB")
 
     stop_time = time.time()
 
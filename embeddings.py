@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import onnxruntime as ort
+from tokenizers import Tokenizer
+
+# --- Shared Embedding Model ---
+# By default the sentence transformer is exported to ONNX once and then served with
+# ONNX Runtime on CPU by both build_database.py and app.py, so PyTorch is never
+# imported at process start. The pinned onnxruntime wheel is CPU-only, so GPU
+# serving is opt-in: EMBEDDING_DEVICE=cuda runs the PyTorch model in FP16 instead.
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+MAX_SEQ_LENGTH = 256 # same truncation as SentenceTransformer uses for this model
+ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", "minilm_onnx")
+EMBEDDING_DEVICE = os.getenv("EMBEDDING_DEVICE", "cpu")
+
+MODEL_FILE = "model.onnx"
+QUANTIZED_MODEL_FILE = "model_int8.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+
+def export_onnx(onnx_dir=ONNX_DIR):
+    """
+        One-time export of the sentence transformer to ONNX, plus an int8 dynamically
+        quantized copy for CPU serving. Only this step needs PyTorch.
+        Files are written to a temporary directory next to onnx_dir and moved into
+        place in one rename, so a crashed or concurrent export never leaves a partial
+        onnx_dir behind.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    print(f"Exporting {MODEL_NAME} to ONNX in {onnx_dir}...")
+    onnx_dir = os.path.abspath(onnx_dir)
+    export_dir = tempfile.mkdtemp(prefix=".onnx_export_", dir=os.path.dirname(onnx_dir))
+
+    model = SentenceTransformer(MODEL_NAME, device="cpu")
+    transformer = model[0].auto_model.eval()
+    dummy = model.tokenizer(["An example sentence"], return_tensors="pt")
+
+    model_path = os.path.join(export_dir, MODEL_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            # Inputs passed by name (trailing dict), the positional order of
+            # the transformer's forward() differs between transformers versions
+            ({name: dummy[name] for name in ("input_ids", "attention_mask", "token_type_ids")},),
+            model_path,
+            input_names=["input_ids", "attention_mask", "token_type_ids"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "token_type_ids": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"}
+            },
+            opset_version=17,
+            dynamo=False
+        )
+    quantize_dynamic(model_path, os.path.join(export_dir, QUANTIZED_MODEL_FILE), weight_type=QuantType.QInt8)
+    model.tokenizer.backend_tokenizer.save(os.path.join(export_dir, TOKENIZER_FILE))
+
+    # A leftover incomplete directory (e.g. from an older interrupted export) is replaced
+    if os.path.isdir(onnx_dir) and not onnx_export_complete(onnx_dir):
+        shutil.rmtree(onnx_dir, ignore_errors=True)
+    try:
+        os.replace(export_dir, onnx_dir)
+    except OSError:
+        # Another process finished its export first, keep that one
+        shutil.rmtree(export_dir, ignore_errors=True)
+        if not onnx_export_complete(onnx_dir):
+            raise
+    print("ONNX export complete")
+
+def onnx_export_complete(onnx_dir=ONNX_DIR):
+    return all(
+        os.path.exists(os.path.join(onnx_dir, file_name))
+        for file_name in (MODEL_FILE, QUANTIZED_MODEL_FILE, TOKENIZER_FILE)
+    )
+
+class OnnxEncoder:
+    """
+        Minimal drop-in for SentenceTransformer.encode on top of ONNX Runtime (CPU):
+        tokenize, run the transformer, mean-pool over the attention mask.
+    """
+    def __init__(self, model_path, tokenizer_path):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id("[PAD]"), pad_token="[PAD]")
+
+    def get_sentence_embedding_dimension(self):
+        return self.session.get_outputs()[0].shape[-1]
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        token_type_ids = np.array([e.type_ids for e in encodings], dtype=np.int64)
+
+        last_hidden_state = self.session.run(
+            ["last_hidden_state"],
+            {"input_ids": input_ids, "attention_mask": attention_mask, "token_type_ids": token_type_ids}
+        )[0]
+
+        # Mean pooling over the real (non-padding) tokens
+        mask = attention_mask[:, :, None].astype(np.float32)
+        return (last_hidden_state*mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, normalize_embeddings=False, show_progress_bar=False):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        # Batch texts of similar length together to minimize padding, then restore the order
+        length_order = np.argsort([-len(s) for s in sentences], kind='stable')
+        sorted_sentences = [sentences[i] for i in length_order]
+        embeddings = np.empty((len(sentences), self.get_sentence_embedding_dimension()), dtype=np.float32)
+        for start in range(0, len(sentences), batch_size):
+            batch_index = length_order[start:start+batch_size]
+            embeddings[batch_index] = self._encode_batch(sorted_sentences[start:start+batch_size])
+
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+
+        return embeddings[0] if single else embeddings
+
+def load_embedding_model(quantized=False, onnx_dir=ONNX_DIR):
+    """
+        Loads the embedding model: the ONNX export on CPU (created first if needed), or the
+        FP16 SentenceTransformer when EMBEDDING_DEVICE=cuda. quantized=True serves the int8
+        ONNX model.
+    """
+    if EMBEDDING_DEVICE == "cuda":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(MODEL_NAME, device="cuda").half()
+
+    if not onnx_export_complete(onnx_dir):
+        export_onnx(onnx_dir)
+
+    model_file = QUANTIZED_MODEL_FILE if quantized else MODEL_FILE
+    return OnnxEncoder(os.path.join(onnx_dir, model_file), os.path.join(onnx_dir, TOKENIZER_FILE))
@@ -1,33 +1,93 @@
 import os
+import asyncio
+import threading
 import pymupdf
 import arxiv
 import requests
 import json
 import re
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared HTTP clients so connections (TCP + TLS) are reused across papers
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+# arxiv.Client waits delay_seconds between consecutive API calls. arXiv titles
+# are fetched in batches (see fetch_arxiv_titles), so that delay applies once per
+# batch rather than once per paper, except for ids retried after a failed batch
+ARXIV_CLIENT = arxiv.Client(page_size=100, delay_seconds=3.0)
+ARXIV_BATCH_SIZE = 25
+
+# PyMuPDF is not thread-safe, so concurrent title lookups take turns on every
+# pymupdf call; only the Semantic Scholar requests actually overlap
+PDF_LOCK = threading.Lock()
+
+# Regex patterns, compiled once at import
+ARXIV_RE = re.compile(r"(\d{4}\.\d{4,5})(v\d+)?")
+DIGIT_RE = re.compile(r'^\d+$')
+LEAD_NUM_RE = re.compile(r'^\d+_')
+ARXIV_PREFIX_RE = re.compile(r'^\d{4}\.\d{4,5}(v\d+)?')
+
+# Font size (pt) from which a span near the top of the first page is taken as the title
+TITLE_FONT_SIZE = 14
 
 # 1. Title extraction from arXiv API
-def extract_title_from_arxiv(filename):
-    arxiv_pattern = r"(\d{4}\.\d{4,5})(v\d+)?"
-    match = re.match(arxiv_pattern,filename.replace('.pdf',''))
+def arxiv_id_from_filename(filename):
+    match = ARXIV_RE.match(filename.replace('.pdf',''))
+    return match.group(1) if match else None
+
+def query_arxiv_titles(arxiv_ids):
+    search = arxiv.Search(id_list=arxiv_ids, max_results=len(arxiv_ids))
+    return {
+        ARXIV_RE.match(paper.get_short_id()).group(1): paper.title
+        for paper in ARXIV_CLIENT.results(search)
+    }
+
+def fetch_arxiv_titles(filenames):
+    """
+    Looks up the titles of every arXiv-named paper in batched API queries of
+    ARXIV_BATCH_SIZE ids, instead of one rate-limited request per paper.
+    If a batch fails, or leaves ids unanswered, those ids are retried one by one
+    so a single bad response only costs the papers it actually affects.
+    Returns {arxiv_id: title}.
+    """
+    arxiv_ids = sorted({arxiv_id for arxiv_id in map(arxiv_id_from_filename, filenames) if arxiv_id})
+    titles = {}
 
-    if match:
-        arxiv_id = match.group(1)
+    for start in range(0, len(arxiv_ids), ARXIV_BATCH_SIZE):
+        batch = arxiv_ids[start:start+ARXIV_BATCH_SIZE]
         try:
-            search = arxiv.Search(id_list=[arxiv_id])
-            paper = next(search.results())
-            return paper.title,'arxiv'
+            titles.update(query_arxiv_titles(batch))
         except Exception as e:
-            print(f"arxiv fetch failed : {e}")
+            print(f"arxiv batch fetch failed, retrying ids one by one : {e}")
 
+        for arxiv_id in batch:
+            if arxiv_id in titles:
+                continue
+            try:
+                titles.update(query_arxiv_titles([arxiv_id]))
+            except Exception as e:
+                print(f"arxiv fetch failed for {arxiv_id} : {e}")
+
+    return titles
+
+def extract_title_from_arxiv(filename, arxiv_titles):
+    title = arxiv_titles.get(arxiv_id_from_filename(filename))
+    if title:
+        return title,'arxiv'
     return None,None
 
 # 2. Title extraction from pdf metadata
 def extract_title_from_pdf_metadata(pdf_path):
     try:
-        doc = pymupdf.open(pdf_path)
-        metadata = doc.metadata
-        doc.close()
+        with PDF_LOCK:
+            doc = pymupdf.open(pdf_path)
+            metadata = doc.metadata
+            doc.close()
 
         if metadata and metadata.get('title'):
             title = metadata['title'].strip()
@@ -37,54 +97,58 @@ def extract_title_from_pdf_metadata(pdf_path):
         pass
     return None,None
 
-def extract_title_from_pdf_text(pdf_path):
+def extract_title_from_pdf_text(pdf_path, log=print):
     """Enhanced title extraction from PDF text"""
     try:
-        doc = pymupdf.open(pdf_path)
-        first_page = doc[0]
+        # Only the PyMuPDF calls need the lock, the spans below are plain dicts
+        with PDF_LOCK:
+            doc = pymupdf.open(pdf_path)
+            try:
+                first_page = doc[0]
+                
+                # Get all text blocks with formatting
+                blocks = first_page.get_text("dict", sort=True)["blocks"]
+                page_middle = first_page.rect.height / 2
+            finally:
+                doc.close()
         
-        # Get all text blocks with formatting
-        blocks = first_page.get_text("dict", sort=True)["blocks"]
+        # Walk every span of the first 15 blocks
+        spans = (span
+                 for block in blocks[:15] if "lines" in block
+                 for line in block["lines"]
+                 for span in line["spans"])
         
-        candidates = []
+        # Keep the largest text, ties going to the one higher on the page
+        best = None # (size, -y_position, text)
         
-        for block in blocks[:15]:  # Check more blocks
-            if "lines" not in block:
-                continue
+        for span in spans:
+            text = span["text"].strip()
+            size = span["size"]
+            
+            # Filter criteria for potential titles
+            if (len(text) > 15 and len(text) < 200 and 
+                not text.isnumeric() and
+                not text.startswith('http') and
+                not DIGIT_RE.match(text) and
+                not text.lower().startswith('abstract')):
                 
-            for line in block["lines"]:
-                for span in line["spans"]:
-                    text = span["text"].strip()
-                    size = span["size"]
-                    
-                    # Filter criteria for potential titles
-                    if (len(text) > 15 and len(text) < 200 and 
-                        not text.isnumeric() and
-                        not text.startswith('http') and
-                        not re.match(r'^\d+$', text) and
-                        not text.lower().startswith('abstract')):
-                        
-                        candidates.append({
-                            'text': text,
-                            'size': size,
-                            'y_position': span['origin'][1]  # Vertical position
-                        })
-        
-        doc.close()
+                y_position = span['origin'][1]  # Vertical position
+                if best is None or (size, -y_position) > best[:2]:
+                    best = (size, -y_position, text)
+                
+                # Titles are almost always the first large span in the top half
+                # of the page, so stop scanning once one has been found
+                if best[0] >= TITLE_FONT_SIZE and -best[1] < page_middle:
+                    break
         
-        if not candidates:
+        if best is None:
             return None, None
         
-        # Sort by font size (descending) and y-position (ascending = higher on page)
-        candidates.sort(key=lambda x: (-x['size'], x['y_position']))
-        
-        # Get the largest text that's near the top
-        if candidates:
-            title = candidates[0]['text'].replace('\n', ' ').strip()
-            return title, 'pdf_text'
+        title = best[2].replace('\n', ' ').strip()
+        return title, 'pdf_text'
             
     except Exception as e:
-        print(f"    PDF text extraction error: {e}")
+        log(f"    PDF text extraction error: {e}")
     
     return None, None
 
@@ -98,7 +162,7 @@ def search_semantic_scholar(title_guess):
             'fields': 'title'
         }
         
-        response = requests.get(url, params=params, timeout=5)
+        response = SESSION.get(url, params=params, timeout=5)
         if response.status_code == 200:
             data = response.json()
             if data.get('data') and len(data['data']) > 0:
@@ -111,8 +175,8 @@ def clean_filename_as_title(filename):
     """Convert filename to readable title as last resort"""
     # Remove extension and numbers
     name = filename.replace('.pdf', '')
-    name = re.sub(r'^\d+_', '', name)  # Remove leading numbers
-    name = re.sub(r'^\d{4}\.\d{4,5}(v\d+)?', '', name)  # Remove arXiv ID
+    name = LEAD_NUM_RE.sub('', name)  # Remove leading numbers
+    name = ARXIV_PREFIX_RE.sub('', name)  # Remove arXiv ID
     
     # Replace underscores and clean up
     name = name.replace('_', ' ').strip()
@@ -125,51 +189,79 @@ def clean_filename_as_title(filename):
 
 
 
-def get_paper_title_multi_strategy(pdf_path,filename):
+def get_paper_title_multi_strategy(pdf_path,filename,arxiv_titles,log=print):
 
     """
     Try multiple strategies in order of reliability:
-    1. arXiv API (most reliable)
+    1. arXiv API (most reliable, looked up in arxiv_titles from fetch_arxiv_titles)
     2. PDF metadata
     3. PDF text extraction
     4. Semantic Scholar verification
     5. Cleaned filename (fallback)
+
+    Progress lines go to `log` (print by default), so concurrent callers can
+    collect them and print each paper's report in one piece.
     """
-    print(f"  Trying arXiv API...", end='')
-    title, source = extract_title_from_arxiv(filename)
+    title, source = extract_title_from_arxiv(filename, arxiv_titles)
     if title:
-        print(f" ✓ Found!")
+        log("  Trying arXiv API... ✓ Found!")
         return title,source
-    print(" ✗")
+    log("  Trying arXiv API... ✗")
     
-    print(f"Trying pdf metadata...",end='')
     title,source = extract_title_from_pdf_metadata(pdf_path)
     if title:
-        print(f" ✓ Found!")
+        log("  Trying pdf metadata... ✓ Found!")
         return title,source
-    print(" ✗")
+    log("  Trying pdf metadata... ✗")
 
-    print(f"  Trying PDF text extraction...", end='')
-    title, source = extract_title_from_pdf_text(pdf_path)
+    title, source = extract_title_from_pdf_text(pdf_path, log)
     if title:
-        print(f" ✓ Found!")
+        log("  Trying PDF text extraction... ✓ Found!")
         
         # Optional: Verify with Semantic Scholar
-        print(f"  Verifying with Semantic Scholar...", end='')
         verified_title, verified_source = search_semantic_scholar(title)
         if verified_title:
-            print(f" ✓ Verified!")
+            log("  Verifying with Semantic Scholar... ✓ Verified!")
             return verified_title, 'semantic_scholar'
-        print(" ✗")
+        log("  Verifying with Semantic Scholar... ✗")
         
         return title, source
-    print(" ✗")
+    log("  Trying PDF text extraction... ✗")
     
-    print(f"  Using filename...", end='')
     title, source = clean_filename_as_title(filename)
-    print(f" ✓")
+    log("  Using filename... ✓")
     return title, source
 
+async def extract_all_titles(papers_folder, pdf_files, max_concurrency=5):
+    """
+    Runs get_paper_title_multi_strategy for all papers concurrently, with at most
+    max_concurrency lookups in flight. Returns (filename, title, source) in pdf_files order.
+    """
+    print("Fetching arXiv titles...")
+    arxiv_titles = await asyncio.to_thread(fetch_arxiv_titles, pdf_files)
+    print(f"Found {len(arxiv_titles)} papers on arXiv")
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def process(i, filename):
+        path = os.path.join(papers_folder, filename)
+        async with semaphore:
+            lines = []
+            title, source = await asyncio.to_thread(get_paper_title_multi_strategy, path, filename, arxiv_titles, lines.append)
+
+            print(f"\n[{i}/{len(pdf_files)}] {filename}")
+            print("\n".join(lines))
+            print(f"  → Title: {title[:70]}{'...' if len(title) > 70 else ''}")
+            print(f"  → Source: {source}")
+
+            # Rate limiting for Semantic Scholar calls (arXiv titles were fetched
+            # up front), the slot is held while sleeping
+            if source == 'semantic_scholar':
+                await asyncio.sleep(0.5)
+        return filename, title, source
+
+    return await asyncio.gather(*[process(i, filename) for i, filename in enumerate(pdf_files, 1)])
+
 if __name__ == "__main__":
     papers_folder = "Papers"
     pdf_files = [f for f in os.listdir(papers_folder) if f.endswith(".pdf")]
@@ -185,12 +277,9 @@ if __name__ == "__main__":
         'filename': 0
     }
 
-    for i, filename in enumerate(pdf_files, 1):
-        print(f"\n[{i}/{len(pdf_files)}] {filename}")
-        path = os.path.join(papers_folder, filename)
-        
-        title, source = get_paper_title_multi_strategy(path, filename)
-        
+    results = asyncio.run(extract_all_titles(papers_folder, pdf_files))
+
+    for filename, title, source in results:
         extracted_titles[filename] = {
             'title': title,
             'source': source,
@@ -198,13 +287,6 @@ if __name__ == "__main__":
         }
         
         sources_count[source] += 1
-        
-        print(f"  → Title: {title[:70]}{'...' if len(title) > 70 else ''}")
-        print(f"  → Source: {source}")
-        
-        # Rate limiting for API calls
-        if source in ['arxiv', 'semantic_scholar']:
-            time.sleep(0.5)
 
     with open('paper_titles.json', 'w', encoding='utf-8') as f:
         json.dump(extracted_titles, f, indent=2, ensure_ascii=False)